@@ -0,0 +1,41 @@
+# cython: language_level=3
+'''
+Compiled parser for ServiceNow date and datetime strings.
+servicenow.py falls back to a pure Python parser if this is not built.
+
+Build in place with:
+    cythonize -i _snfast.pyx
+'''
+
+cdef inline int _digits(const unsigned char* p, int n) except -1:
+    cdef int i, c
+    cdef int value = 0
+    for i in range(n):
+        c = p[i] - 48  # '0'
+        if c < 0 or c > 9:
+            raise ValueError('Invalid digit')
+        value = value * 10 + c
+    return value
+
+cpdef tuple parse_sn_datetime(bytes s):
+    """
+    Parse YYYY-MM-DD or YYYY-MM-DD HH:MM:SS.
+    Return a tuple (year, month, day, hour, minute, second).
+    """
+    cdef Py_ssize_t n = len(s)
+    cdef const unsigned char* buf = s
+    cdef int h = 0, mi = 0, se = 0
+    if n == 19:
+        # ' ', ':', ':'
+        if buf[10] != 32 or buf[13] != 58 or buf[16] != 58:
+            raise ValueError('Invalid datetime: %r' % s)
+        h = _digits(buf + 11, 2)
+        mi = _digits(buf + 14, 2)
+        se = _digits(buf + 17, 2)
+    elif n != 10:
+        raise ValueError('Invalid datetime: %r' % s)
+    # '-', '-'
+    if buf[4] != 45 or buf[7] != 45:
+        raise ValueError('Invalid datetime: %r' % s)
+    return (_digits(buf, 4), _digits(buf + 5, 2), _digits(buf + 8, 2),
+        h, mi, se)
@@ -4,24 +4,145 @@ Created on Jun 13, 2015
 @author: LewisGF
 '''
 import requests, json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
 import logging
-from pytz import timezone
+import asyncio
+import functools
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from zoneinfo import ZoneInfo
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    _loads = json.loads
+    def _dumps(obj):
+        return json.dumps(obj).encode('utf-8')
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
-TZ_UTC   = timezone('UTC')
-TZ_LOCAL = timezone('US/Eastern')
+@functools.lru_cache(maxsize=None)
+def _get_tz(name):
+    return ZoneInfo(name)
+
+TZ_UTC   = datetime.timezone.utc
+TZ_LOCAL = _get_tz('US/Eastern')
 
 DATE_FORMAT     = '%Y-%m-%d'
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 ACCEPT_JSON = {'Accept': 'application/json'}
+CONTENT_JSON = {'Content-Type': 'application/json'}
+
+# Query parameters for Table.get; these must not be modified
+_REF_LINKS_ON  = {'sysparm_exclude_reference_link': 'false'}
+_REF_LINKS_OFF = {'sysparm_exclude_reference_link': 'true'}
+
+# Connection pool settings for the shared requests.Session
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE     = 20
+RETRY_STATUS     = [429, 500, 502, 503, 504]
+
+# Number of seconds that Table.getChoices results are cached
+CHOICES_TTL = 300
+
+# Maximum number of records per table kept for ETag revalidation in Table.get
+ETAG_CACHE_SIZE = 1000
 
 def setLocalTimeZone(tzname):
     global TZ_LOCAL
-    TZ_LOCAL = timezone(tzname)
+    TZ_LOCAL = _get_tz(tzname)
+
+try:
+    from _snfast import parse_sn_datetime
+except ImportError:
+    parse_sn_datetime = None
+
+def _field(s, start, end):
+    # digits only, as in _snfast; int() would also accept signs, spaces and _
+    f = s[start:end]
+    if not (f.isascii() and f.isdigit()):
+        raise ValueError('Invalid datetime: ' + s)
+    return int(f)
+
+def _parse_fields(s):
+    """
+    Pure Python version of _snfast.parse_sn_datetime.
+    Return a tuple (year, month, day, hour, minute, second).
+    """
+    if len(s) == 10:
+        h = mi = se = 0
+    elif len(s) == 19 and s[10] == ' ' and s[13] == ':' and s[16] == ':':
+        h, mi, se = _field(s, 11, 13), _field(s, 14, 16), _field(s, 17, 19)
+    else:
+        raise ValueError('Invalid datetime: ' + s)
+    if s[4] != '-' or s[7] != '-':
+        raise ValueError('Invalid datetime: ' + s)
+    return (_field(s, 0, 4), _field(s, 5, 7), _field(s, 8, 10), h, mi, se)
+
+def _fast_parse(s, local=False):
+    """
+    Parse a ServiceNow date (YYYY-MM-DD) or datetime (YYYY-MM-DD HH:MM:SS).
+    The result is in UTC unless local is true, in which case it is
+    in TZ_LOCAL.
+    """
+    if parse_sn_datetime is not None:
+        fields = parse_sn_datetime(s.encode('ascii'))
+    else:
+        fields = _parse_fields(s)
+    tz = TZ_LOCAL if local else TZ_UTC
+    return datetime.datetime(*fields, tzinfo=tz)
+
+# Constructors for DateTime.__new__; each returns an aware datetime in UTC
+
+def _from_str(arg, local):
+    # argument is a str as YYYY-MM-DD HH:MM:SS
+    # if time is missing it is set to midnight
+    dt = _fast_parse(arg, local)
+    if local:
+        dt = dt.astimezone(TZ_UTC)
+    return dt
+
+def _from_datetime(arg, local):
+    # argument is a datetime.datetime object
+    if arg.tzinfo is None:
+        if local:
+            return arg.replace(tzinfo=TZ_LOCAL).astimezone(TZ_UTC)
+        return arg.replace(tzinfo=TZ_UTC)
+    return arg.astimezone(TZ_UTC)
+
+def _from_date(arg, local):
+    # argument is a datetime.date object
+    tz = TZ_LOCAL if local else TZ_UTC
+    dt = datetime.datetime(arg.year, arg.month, arg.day, tzinfo=tz)
+    return dt.astimezone(TZ_UTC)
+
+# DateTime.__new__ looks up the exact argument type here
+_DT_DISPATCH = {
+    str: _from_str,
+    datetime.datetime: _from_datetime,
+    datetime.date: _from_date,
+    }
+
+# last value returned by DateTime.today()
+# stored as one (key, value) tuple so that threads never see a mixed pair
+_today_cache = None
 
 class DateTime(datetime.datetime):
     """
@@ -33,44 +154,37 @@ class DateTime(datetime.datetime):
     Example:
         d1 = DateTime('2015-09-15 13:45:00')
     """       
+    __slots__ = ()
+
     def __new__(cls, arg, local=False):
-        if isinstance(arg, str):
-            # argument is a str as YYYY-MM-DD HH:MM:SS
-            if len(arg) == 10:
-                # time is mising; set it to midnight 
-                arg += ' 00:00:00'
-            dt = datetime.datetime.strptime(arg, DATETIME_FORMAT)
-            if local:
-                dt = TZ_LOCAL.localize(dt).astimezone(TZ_UTC)
+        handler = _DT_DISPATCH.get(type(arg))
+        if handler is None:
+            # argument may be a subclass of one of the supported types
+            if isinstance(arg, str):
+                handler = _from_str
+            elif isinstance(arg, datetime.datetime):
+                handler = _from_datetime
+            elif isinstance(arg, datetime.date):
+                handler = _from_date
             else:
-                dt = dt.replace(tzinfo=TZ_UTC)
-        else:
-            if isinstance(arg, datetime.datetime):
-                # argument is a datetime.datetime object
-                if arg.tzinfo is None:
-                    if local:
-                        dt = TZ_LOCAL.localize(arg).astimezone(TZ_UTC)
-                    else:
-                        dt = arg.replace(tzinfo=TZ_UTC)
-                else:
-                    dt = arg.astimezone(TZ_UTC)
-            else:
-                if isinstance(arg, datetime.date):
-                    # argument is a datetime.date object
-                    if local:
-                        dt = TZ_LOCAL.localize(
-                            datetime.datetime(arg.year, arg.month, arg.day))
-                    else:
-                        dt = TZ_UTC.localize(
-                            datetime.datetime(arg.year, arg.month, arg.day))
-                    dt = dt.astimezone(TZ_UTC)
-                else:
-                    raise ValueError('Invalid argument type: ' + str(type(arg)))
+                raise ValueError('Invalid argument type: ' + str(type(arg)))
+        dt = handler(arg, local)
         return super().__new__(cls, 
             dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, tzinfo=TZ_UTC)
         
+    @classmethod
+    def _from_aware(cls, dt):
+        """
+        Construct from an aware datetime that is already in UTC,
+        bypassing the argument checks in __new__.
+        """
+        return super().__new__(cls,
+            dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, tzinfo=TZ_UTC)
+
     def asLocal(self):
-        return self.astimezone(TZ_LOCAL).strftime(DATETIME_FORMAT)
+        # astimezone() on a subclass would call DateTime() with datetime fields
+        local = datetime.datetime.fromtimestamp(self.timestamp(), TZ_LOCAL)
+        return local.strftime(DATETIME_FORMAT)
     
     def asUTC(self):
         return self.astimezone(TZ_UTC).strftime(DATETIME_FORMAT)
@@ -84,13 +198,37 @@ class DateTime(datetime.datetime):
         
     @staticmethod
     def today(local=True):
-        t = DateTime.now().asLocal()[0:10]
-        return DateTime(t, local=local)
+        global _today_cache
+        now = datetime.datetime.now(TZ_LOCAL)
+        key = (now.date(), local, TZ_LOCAL)
+        c = _today_cache
+        if c is not None and c[0] == key:
+            return c[1]
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0,
+            tzinfo=None)
+        value = DateTime(midnight, local=local)
+        _today_cache = (key, value)
+        return value
+
+_DT_DISPATCH[DateTime] = _from_datetime
+
+_EPOCH_NAIVE = datetime.datetime(1970, 1, 1)
+_EPOCH_AWARE = _EPOCH_NAIVE.replace(tzinfo=TZ_UTC)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+def _epochMicros(dt):
+    """
+    Return a datetime as exact integer microseconds since the epoch.
+    Naive datetimes are measured from a naive epoch, as subtraction does.
+    """
+    epoch = _EPOCH_NAIVE if dt.tzinfo is None else _EPOCH_AWARE
+    return (dt - epoch) // _MICROSECOND
 
 class DateTimeRange(tuple):
     """
     This class represents a datetime range, i.e. a pair of datetimes
     """
+    __slots__ = ()
     
     def __new__(cls, dt1, dt2):
         if not isinstance(dt1, datetime.datetime): raise ValueError('dt1 not datetime')
@@ -111,10 +249,12 @@ class DateTimeRange(tuple):
         """        
         Convert a date into a pair of DateTime values that are 24 hours apart
         """
-        t0 = DateTime(ymd.strftime(DATE_FORMAT), local=local)
+        tz = TZ_LOCAL if local else TZ_UTC
+        t0 = datetime.datetime(ymd.year, ymd.month, ymd.day,
+            tzinfo=tz).astimezone(TZ_UTC)
         almost24hours = datetime.timedelta(seconds=(24*60*60 - 1))
-        t1 = DateTime(t0 + almost24hours)
-        r = DateTimeRange(t0, t1)
+        t1 = t0 + almost24hours
+        r = DateTimeRange(DateTime._from_aware(t0), DateTime._from_aware(t1))
         # logging.DEBUG('rangeFromDate(%s)=%s' % (ymd, str(r)))
         return r
     
@@ -126,46 +266,82 @@ class DateTimeRange(tuple):
         latest_start = max(self[0], other[0])
         earliest_end = min(self[1], other[1])
         if latest_start >= earliest_end:
-            diff_sec = 0
-        else:
-            diff_sec = (earliest_end - latest_start).total_seconds()
-        return diff_sec
+            return 0
+        return (earliest_end - latest_start).total_seconds()
+
+    @staticmethod
+    def overlap_matrix(ranges_a, ranges_b):
+        """
+        Return a numpy array of the overlap in seconds between every range
+        in ranges_a (rows) and every range in ranges_b (columns).
+        The values are the same as overlapSeconds would return.
+        Requires numpy.
+        """
+        import numpy as np
+        a = np.array([(_epochMicros(r[0]), _epochMicros(r[1]))
+            for r in ranges_a], dtype=np.int64).reshape(-1, 2)
+        b = np.array([(_epochMicros(r[0]), _epochMicros(r[1]))
+            for r in ranges_b], dtype=np.int64).reshape(-1, 2)
+        micros = np.maximum(0,
+            np.minimum(a[:, 1, None], b[None, :, 1]) -
+            np.maximum(a[:, 0, None], b[None, :, 0]))
+        return micros / 1e6
 
     def overlapsWith(self, other):
-        return self.overlapSeconds(other) > 0
+        return max(self[0], other[0]) < min(self[1], other[1])
         
 class ServiceNowError(RuntimeError):
     pass
 
+# Details of the most recent request, for logging
+RequestInfo = collections.namedtuple('RequestInfo', ['method', 'url', 'params'])
+
 DEBUG_LEN = 256
 
 def logRequest(logger, request, level=logging.DEBUG):
     if logger.isEnabledFor(level):
-        logger.log(level, 'request=%s' % request)
+        logger.log(level, 'request=%s', request)
         
-def logResponse(logger, response, level=logging.DEBUG):
+def logResponse(logger, response, level=logging.DEBUG, body=True):
     if logger.isEnabledFor(level):
-        logger.log(level, 'status_code=%s' % response.status_code)
-        logger.log(level, 'headers=%s' % response.headers)
+        logger.log(level, 'status_code=%s', response.status_code)
+        logger.log(level, 'headers=%s', response.headers)
         # logging.DEBUG('cookies=%s' % response.cookies)       
-        text = response.text
-        if DEBUG_LEN is not None and len(text) > DEBUG_LEN:
-            text = text[0:DEBUG_LEN] + '<<truncated>>'
-        logger.log(level, 'text=%s' % text)
+        if not body: return
+        logger.log(level, 'text=%s', _bodyText(response))
+
+def _bodyText(response):
+    """
+    Return the response body as text, truncated to DEBUG_LEN.
+    Only the part of the body that is returned is decoded.
+    """
+    content = response.content
+    if DEBUG_LEN is not None and len(content) > DEBUG_LEN:
+        text = content[0:DEBUG_LEN].decode('utf-8', errors='replace')
+        return text + '<<truncated>>'
+    return content.decode('utf-8', errors='replace')
     
+def _baseURL(instance):
+    """
+    Return the base URL for an instance name or URL.
+    """
+    if instance.startswith('https://'): 
+        base = str(instance)
+    else: 
+        base = 'https://' + str(instance);
+    if instance.find('.') < 0: base += '.service-now.com'
+    if base.endswith('/'): base = base[0:-1] # remove trailing slash
+    return base
+
 class ServiceNow:
     """
     This class holds the connection credentials for a ServiceNow instance.
     """
+    __slots__ = ('baseurl', 'username', 'auth', 'jsessionid', 'cookies',
+        'lastRequest', 'lastResponse', '_session', '_table_cache')
     
     def __init__(self, instance, username, password, debug=False):
-        if instance.startswith('https://'): 
-            base = str(instance)
-        else: 
-            base = 'https://' + str(instance);
-        if instance.find('.') < 0: base += '.service-now.com'
-        if base.endswith('/'): base = base[0:-1] # remove trailing slash
-        self.baseurl = base
+        self.baseurl = _baseURL(instance)
         self.username = username
         # self.password = password
         self.auth = (username, password)
@@ -173,9 +349,33 @@ class ServiceNow:
         self.cookies = None
         self.lastRequest = None
         self.lastResponse = None
+        self._table_cache = {}
+        # Reuse keep-alive connections across requests
+        retry = Retry(total=3, backoff_factor=0.2, status_forcelist=RETRY_STATUS,
+            raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+            pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount('https://', adapter)
+        self._session.auth = self.auth
+        self._session.headers.update(ACCEPT_JSON)
+
+    def close(self):
+        """
+        Release the pooled connections.
+        """
+        self._session.close()
 
     def table(self, name):
-        return Table(self, name)
+        """
+        Return a Table object.
+        Table objects are cached, so repeated calls return the same object.
+        """
+        t = self._table_cache.get(name)
+        if t is None:
+            t = Table(self, name)
+            self._table_cache[name] = t
+        return t
     
     def url(self, stuff):
         result = self.baseurl
@@ -211,22 +411,23 @@ class ServiceNow:
                 'Unable to connect to %s as %s' % (self.baseurl, self.username)) 
         return self
 
-    def _request(self, method, url, sys_id=None, params=None, data=None):
+    def _request(self, method, url, sys_id=None, params=None, data=None,
+            headers=None, **kwargs):
+        # a streamed body can only be read once, so it is not logged
+        stream = kwargs.get('stream', False)
+        # method must be uppercase
         if sys_id: url += '/' + sys_id
-        method = method.upper()
-        self.lastRequest = {
-            'method' : method,
-            'url' : url,
-            'params' : params,
-            }
+        self.lastRequest = RequestInfo(method, url, params)
         if logger.isEnabledFor(logging.DEBUG):
             logRequest(logger, self.lastRequest, logging.DEBUG)
-        self.lastResponse = requests.request(method, url, 
-            headers=ACCEPT_JSON, params=params, data=data, 
-            auth=self.auth, cookies=self.cookies)
+        if data is not None:
+            headers = dict(headers, **CONTENT_JSON) if headers else CONTENT_JSON
+        self.lastResponse = self._session.request(method, url,
+            params=params, data=data, cookies=self.cookies,
+            headers=headers, **kwargs)
         if logger.isEnabledFor(logging.DEBUG):
-            logResponse(logger, self.lastResponse, logging.DEBUG)
-        if self.lastResponse.status_code != 200:
+            logResponse(logger, self.lastResponse, logging.DEBUG, body=not stream)
+        if self.lastResponse.status_code not in (200, 304):
             logRequest(logger, self.lastRequest, logging.INFO)
             logResponse(logger, self.lastResponse, logging.INFO)
         self._setSession(self.lastResponse)
@@ -246,15 +447,26 @@ class ServiceNow:
             self.cookies = dict(JSESSIONID=jsessionid) 
     
 class Table():
+    __slots__ = ('session', 'name', 'tableurl', 'tableurl_prefix', 'response',
+        '_etag_cache', '_choices_cache')
 
     def __init__(self, sn, name):        
         self.session = sn
         self.name = name
         self.tableurl = sn.url('/api/now/v1/table/' + name)
+        self.tableurl_prefix = self.tableurl + '/'
+        # (sys_id, refLinks) -> (etag, body); least recently used first
+        self._etag_cache = collections.OrderedDict()
+        self._choices_cache = {} # (element, inactive) -> (expires, choices)
     
-    def _request(self, method, sys_id=None, params=None, data=None):
-        return self.session._request(method, self.tableurl, 
-            sys_id=sys_id, params=params, data=data)
+    def _request(self, method, sys_id=None, params=None, data=None,
+            headers=None, **kwargs):
+        if sys_id:
+            url = self.tableurl_prefix + sys_id
+        else:
+            url = self.tableurl
+        return self.session._request(method, url, 
+            params=params, data=data, headers=headers, **kwargs)
         
 #     def _print_response(self, method, response):
 #         return self.session._print_response(method, self.tableurl, response)
@@ -271,18 +483,32 @@ class Table():
         If no corresponding sys_id exists then None is returned.        
         If refLinks is true then each reference field will contain two values:
         'value' (sys_id) and 'link' (URL).
+        If the server returned an ETag for the record then the response
+        body is cached (up to ETAG_CACHE_SIZE records per table),
+        and a 304 (Not Modified) response returns the cached record.
         """
-        parms = {}
-        if (refLinks):
-            parms['sysparm_exclude_reference_link'] = 'false'
-        else:
-            parms['sysparm_exclude_reference_link'] = 'true'
-        self.response = self._request('GET', sys_id, parms)
+        params = _REF_LINKS_ON if refLinks else _REF_LINKS_OFF
+        key = (sys_id, refLinks)
+        cache = self._etag_cache
+        cached = cache.get(key)
+        headers = {'If-None-Match': cached[0]} if cached else None
+        self.response = self._request('GET', sys_id, params, headers=headers)
+        if self.response.status_code == 304 and cached:
+            cache.move_to_end(key)
+            # parse again so that callers never share a cached record
+            return _loads(cached[1])['result']
         if self.response.status_code == 401:
-            raise ServiceNowError('Unauthorized\n%s' % (self.response.json()))
+            raise ServiceNowError('Unauthorized\n%s' % (_loads(self.response.content)))
         if self.response.status_code == 404:
+            cache.pop(key, None)
             return None
-        result = self.response.json()['result']
+        result = _loads(self.response.content)['result']
+        etag = self.response.headers.get('ETag')
+        if etag:
+            cache[key] = (etag, self.response.content)
+            cache.move_to_end(key)
+            if len(cache) > ETAG_CACHE_SIZE:
+                cache.popitem(last=False)
         return result
                         
     def insert(self, record, fields=None):
@@ -292,7 +518,7 @@ class Table():
         If fields==None then return a sys_id.
         Otherwise return return a dict containing specified fields.
         """
-        data = json.dumps(record)
+        data = _dumps(record)
         if fields:
             if isinstance(fields, str):
                 sysparm_fields = fields
@@ -304,19 +530,27 @@ class Table():
         self.response = self._request('POST', params=params, data=data)
         if not 200 <= self.response.status_code <= 299:
             raise ServiceNowError('Status: %s\nHeaders: %s\n%s' % 
-                (self.response.status_code, self.response.headers, self.response.json()))
-        result = self.response.json()['result']
+                (self.response.status_code, self.response.headers, _loads(self.response.content)))
+        result = _loads(self.response.content)['result']
         if fields:
             return result
         else:
             return result['sys_id']
-        
+
+    def insert_many(self, records, fields=None):
+        """
+        Insert a list of records.
+        Each record is sent as its own request over the pooled connection.
+        Returns a list with one result per record, as returned by insert.
+        """
+        return [self.insert(record, fields=fields) for record in records]
+
     def update(self, sys_id, fieldvalues):
         """
         Update a single record.
         Pass in a sys_id and a dict of field values.
         """
-        data = json.dumps(fieldvalues)
+        data = _dumps(fieldvalues)
         self._request('PUT', sys_id=sys_id, data=data)
         
     def delete(self, sys_id):
@@ -330,7 +564,12 @@ class Table():
         Return a dict of the values of a choice field.
         If inactive==False then only active values will be included.
         Otherwise all values will be included.
+        Results are cached for CHOICES_TTL seconds.
         """
+        key = (element, inactive)
+        cached = self._choices_cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            return dict(cached[1])
         sys_choice = self.session.table('sys_choice')
         query_str = 'name=' + self.name + '^element=' + element
         result = {}
@@ -342,13 +581,40 @@ class Table():
                 result[rec['value']] = rec['label']
         if not len(result): self.session.logLastRequest()
         assert len(result), 'getChoices returned no values'
+        self._choices_cache[key] = (time.monotonic() + CHOICES_TTL, dict(result))
         return result
         
+def _paramProperty(name, doc):
+    """
+    Return a Query property that is stored in the request parameters,
+    so that run() always sees the current value.
+    The setter replaces _params rather than changing it, so a params dict
+    already passed to a request (e.g. in lastRequest) is never modified.
+    """
+    def fget(self):
+        return self._params.get(name)
+    def fset(self, value):
+        params = dict(self._params)
+        if value:
+            params[name] = value
+        else:
+            params.pop(name, None)
+        self._params = params
+    return property(fget, fset, doc=doc)
+
 class Query:
+    __slots__ = ('table', 'session', 'response', '_params')
+
+    query = _paramProperty('sysparm_query', 'Encoded query string')
+    fields = _paramProperty('sysparm_fields', 'Comma separated list of fields')
+    limit = _paramProperty('sysparm_limit', 'Maximum number of rows')
+    exclude_ref_links = _paramProperty('sysparm_exclude_reference_link',
+        "'true' or 'false'")
      
     def __init__(self, table, query=None, fields=None, limit=None, refLinks=False):
         self.table = table
         self.session = table.session
+        self._params = {} # request parameters; see _paramProperty
         self.setQuery(query)
         self.setFields(fields)
         self.setLimit(limit)
@@ -405,19 +671,279 @@ class Query:
         If there are no qualifying records then an empty tuple is returned.
         """
         table = self.table
-        params = {}
-        if (self.limit):
-            params['sysparm_limit'] = self.limit
-        if (self.fields):
-            params['sysparm_fields'] = self.fields
-        if (self.query):
-            params['sysparm_query'] = self.query
-        if (self.exclude_ref_links):
-            params['sysparm_exclude_reference_link'] = self.exclude_ref_links 
-        self.response = table._request('GET', params=params)
+        self.response = table._request('GET', params=self._params)
         if self.response.status_code != 200:
             # table._print_response('GET', self.response)
             return list()
-        json = self.response.json()
-        return json['result']
+        return _loads(self.response.content)['result']
 
+    def run_iter(self):
+        """
+        This function runs the query.
+        It is a generator which yields one dict per record as the
+        response is parsed, so the full response is never held in memory.
+        Streaming requires the ijson package; without it the response
+        is parsed in one piece. On success the body is consumed while
+        parsing, so use run() if self.response.content is needed.
+        """
+        table = self.table
+        self.response = table._request('GET', params=self._params, stream=True)
+        try:
+            if self.response.status_code != 200:
+                # read the error body so that it is still available after close
+                self.response.content
+                return
+            if ijson is None:
+                yield from _loads(self.response.content)['result']
+            else:
+                self.response.raw.decode_content = True
+                yield from ijson.items(self.response.raw, 'result.item',
+                    use_float=True)
+        finally:
+            self.response.close()
+
+    def run_all(self, page_size=1000, max_workers=8):
+        """
+        This function runs the query, fetching the results in pages
+        of page_size rows. Up to max_workers pages are requested concurrently.
+        It returns a list of dicts in the same order as run().
+        """
+        table = self.table
+        params = self._params
+        # fetch a single row to learn the total number of rows
+        probe = dict(params, sysparm_limit='1')
+        self.response = table._request('GET', params=probe)
+        if self.response.status_code != 200:
+            return list()
+        if 'X-Total-Count' not in self.response.headers:
+            # row count unknown; fetch everything in one request
+            return self.run()
+        total = int(self.response.headers['X-Total-Count'])
+        if self.limit:
+            total = min(total, int(self.limit))
+
+        def fetch(offset):
+            page = dict(params, sysparm_offset=str(offset),
+                sysparm_limit=str(min(page_size, total - offset)))
+            response = table._request('GET', params=page)
+            if response.status_code != 200:
+                raise ServiceNowError('Status: %s\nHeaders: %s\n%s' %
+                    (response.status_code, response.headers, _bodyText(response)))
+            return _loads(response.content)['result']
+
+        result = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for page in executor.map(fetch, range(0, total, page_size)):
+                result.extend(page)
+        return result
+
+
+class AsyncServiceNow:
+    """
+    This class is an asyncio version of ServiceNow.
+    Requests are sent with an httpx.AsyncClient, so many queries can be
+    in flight at once on a single event loop. It requires httpx;
+    http2=True also requires the h2 package.
+    timeout is in seconds; by default requests never time out,
+    as with ServiceNow.
+
+    Example:
+        async with AsyncServiceNow(instance, username, password) as sn:
+            queries = [sn.table(name).query() for name in names]
+            results = await asyncio.gather(*[q.run() for q in queries])
+    """
+    __slots__ = ('baseurl', 'username', 'auth', 'lastRequest', 'lastResponse',
+        '_client', '_table_cache')
+
+    def __init__(self, instance, username, password, http2=True,
+            timeout=None):
+        if httpx is None:
+            raise ImportError('AsyncServiceNow requires httpx')
+        self.baseurl = _baseURL(instance)
+        self.username = username
+        self.auth = (username, password)
+        self.lastRequest = None
+        self.lastResponse = None
+        self._table_cache = {}
+        limits = httpx.Limits(max_connections=POOL_MAXSIZE,
+            max_keepalive_connections=POOL_MAXSIZE)
+        self._client = httpx.AsyncClient(auth=self.auth, headers=ACCEPT_JSON,
+            http2=http2, limits=limits, timeout=timeout)
+
+    async def close(self):
+        """
+        Release the pooled connections.
+        """
+        await self._client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def table(self, name):
+        """
+        Return an AsyncTable object.
+        Table objects are cached, so repeated calls return the same object.
+        """
+        t = self._table_cache.get(name)
+        if t is None:
+            t = AsyncTable(self, name)
+            self._table_cache[name] = t
+        return t
+
+    url = ServiceNow.url
+    link = ServiceNow.link
+
+    async def _request(self, method, url, params=None, data=None):
+        # method must be uppercase
+        self.lastRequest = RequestInfo(method, url, params)
+        if logger.isEnabledFor(logging.DEBUG):
+            logRequest(logger, self.lastRequest, logging.DEBUG)
+        self.lastResponse = await self._client.request(method, url,
+            params=params, content=data,
+            headers=CONTENT_JSON if data is not None else None)
+        if logger.isEnabledFor(logging.DEBUG):
+            logResponse(logger, self.lastResponse, logging.DEBUG)
+        if self.lastResponse.status_code != 200:
+            logRequest(logger, self.lastRequest, logging.INFO)
+            logResponse(logger, self.lastResponse, logging.INFO)
+        return self.lastResponse
+
+class AsyncTable:
+    """
+    This class is an asyncio version of Table.
+    """
+    __slots__ = ('session', 'name', 'tableurl', 'tableurl_prefix', 'response')
+
+    def __init__(self, sn, name):
+        self.session = sn
+        self.name = name
+        self.tableurl = sn.url('/api/now/v1/table/' + name)
+        self.tableurl_prefix = self.tableurl + '/'
+
+    async def _request(self, method, sys_id=None, params=None, data=None):
+        if sys_id:
+            url = self.tableurl_prefix + sys_id
+        else:
+            url = self.tableurl
+        return await self.session._request(method, url,
+            params=params, data=data)
+
+    def query(self, query=None, fields=None, limit=None):
+        """
+        Create an AsyncQuery object
+        """
+        return AsyncQuery(self, query=query, fields=fields, limit=limit)
+
+    async def get(self, sys_id, refLinks=False):
+        """
+        Retrieve a single record.
+        If no corresponding sys_id exists then None is returned.
+        """
+        params = _REF_LINKS_ON if refLinks else _REF_LINKS_OFF
+        self.response = await self._request('GET', sys_id, params)
+        if self.response.status_code == 401:
+            raise ServiceNowError('Unauthorized\n%s' % (_loads(self.response.content)))
+        if self.response.status_code == 404:
+            return None
+        return _loads(self.response.content)['result']
+
+    async def insert(self, record, fields=None):
+        """
+        Insert a single record.
+        If fields==None then return a sys_id.
+        Otherwise return return a dict containing specified fields.
+        """
+        data = _dumps(record)
+        if fields:
+            if isinstance(fields, str):
+                sysparm_fields = fields
+            else:
+                sysparm_fields = ','.join(fields)
+        else:
+            sysparm_fields = 'sys_id'
+        params = {'sysparm_fields': sysparm_fields} # values we want returned
+        self.response = await self._request('POST', params=params, data=data)
+        if not 200 <= self.response.status_code <= 299:
+            raise ServiceNowError('Status: %s\nHeaders: %s\n%s' %
+                (self.response.status_code, self.response.headers, _loads(self.response.content)))
+        result = _loads(self.response.content)['result']
+        if fields:
+            return result
+        else:
+            return result['sys_id']
+
+    async def update(self, sys_id, fieldvalues):
+        """
+        Update a single record.
+        """
+        await self._request('PUT', sys_id=sys_id, data=_dumps(fieldvalues))
+
+    async def delete(self, sys_id):
+        """
+        Delete a single record.
+        """
+        await self._request('DELETE', sys_id=sys_id)
+
+class AsyncQuery(Query):
+    """
+    This class is an asyncio version of Query.
+    The set methods are inherited; run and run_all are coroutines.
+    """
+    __slots__ = ()
+
+    async def run(self):
+        """
+        This function runs the query. 
+        It returns a list of dicts.
+        """
+        self.response = await self.table._request('GET', params=self._params)
+        if self.response.status_code != 200:
+            return list()
+        return _loads(self.response.content)['result']
+
+    async def run_iter(self):
+        """
+        This function runs the query and yields one dict per record.
+        """
+        for rec in await self.run():
+            yield rec
+
+    async def run_all(self, page_size=1000):
+        """
+        This function runs the query, fetching the results in pages
+        of page_size rows. All pages are requested concurrently; the number
+        of open connections is limited by the client.
+        It returns a list of dicts in the same order as run().
+        """
+        table = self.table
+        params = self._params
+        # fetch a single row to learn the total number of rows
+        probe = dict(params, sysparm_limit='1')
+        self.response = await table._request('GET', params=probe)
+        if self.response.status_code != 200:
+            return list()
+        if 'X-Total-Count' not in self.response.headers:
+            # row count unknown; fetch everything in one request
+            return await self.run()
+        total = int(self.response.headers['X-Total-Count'])
+        if self.limit:
+            total = min(total, int(self.limit))
+
+        async def fetch(offset):
+            page = dict(params, sysparm_offset=str(offset),
+                sysparm_limit=str(min(page_size, total - offset)))
+            response = await table._request('GET', params=page)
+            if response.status_code != 200:
+                raise ServiceNowError('Status: %s\nHeaders: %s\n%s' %
+                    (response.status_code, response.headers, _bodyText(response)))
+            return _loads(response.content)['result']
+
+        pages = await asyncio.gather(
+            *[fetch(offset) for offset in range(0, total, page_size)])
+        result = []
+        for page in pages:
+            result.extend(page)
+        return result